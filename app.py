@@ -1,17 +1,28 @@
 # YieldWise AI - Agricultural Platform
 # Using ONLY Gemini API for all AI features
 
+import io
 import os
+import secrets
+import functools
+import hashlib
+import itertools
+import queue
+import re
 import sqlite3
-import uuid
-import markdown
+import string
+import threading
+import zlib
+import cmarkgfm
+import orjson
 from flask import (
     Flask, render_template, request, jsonify, abort, redirect, url_for, flash,
-    make_response, session
+    make_response, session, Response, stream_with_context, g, send_file
 )
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 from datetime import datetime
+from cachetools import TTLCache, cached
 
 # User Management & Security
 from flask_login import (
@@ -20,20 +31,51 @@ from flask_login import (
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from flask_compress import Compress
+from flask.json.provider import DefaultJSONProvider
 
-# PDF & Image Handling
-from weasyprint import HTML
-import google.generativeai as genai
-from PIL import Image
+# WeasyPrint, PIL and the Gemini SDK are heavy to import, so they are loaded on
+# first use rather than by every worker at startup
 
 # Load environment variables
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask's JSON provider backed by orjson; dates and other extra types still go through Flask's default()"""
+    
+    def _encode(self, obj, sort_keys, indent):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
+    
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj, kwargs.get('sort_keys', self.sort_keys), kwargs.get('indent')).decode()
+    
+    def response(self, *args, **kwargs):
+        """jsonify() without the str round-trip; orjson's bytes become the body as they are"""
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self._encode(obj, self.sort_keys, indent) + b'\n', mimetype=self.mimetype)
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask and extensions
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', os.urandom(24))
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+ALLOWED_SUFFIXES = ('.png', '.jpg', '.jpeg')
+
+# Compress HTML and JSON responses; streamed responses (SSE, the data export) are
+# left alone so their chunks still reach the browser as they are produced
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
 
 limiter = Limiter(get_remote_address, app=app, default_limits=["200 per day", "50 per hour"])
 login_manager = LoginManager(app)
@@ -41,25 +83,232 @@ login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
 
 # --- GEMINI API SETUP (ONLY AI PROVIDER) ---
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-exp'
+
+# The fixed instructions are sent as system_instruction so every request shares
+# an identical prefix (which Gemini caches) and only the farmer's details vary
+FARM_PLAN_INSTRUCTION = """You are an expert Nigerian agronomist and agricultural business consultant with deep knowledge of West African farming. Create a comprehensive farm business plan for the farm described by the user.
+
+**Instructions:**
+Generate a detailed business plan in markdown format with these sections:
+
+1. **🌱 Recommended Crop**
+   - Choose ONE highly profitable, fast-growing crop ideal for the farm's location
+   - Prioritize crops proven successful for Nigerian/African smallholder farmers
+   - Explain why this crop is perfect for their location, budget, and local market demand
+
+2. **💰 Budget Breakdown (in the farmer's currency)**
+   - Create a detailed markdown table breaking down the EXACT budget
+   - Include: seeds/seedlings, fertilizer (organic & chemical options), tools, water/irrigation, labor, transportation, miscellaneous
+   - Show total = the farmer's budget
+   - Use realistic local market prices
+
+3. **🗓️ 90-Day Action Plan**
+   - Week 1-2: Land preparation and initial steps (consider Nigerian weather patterns)
+   - Week 3-4: Planting and setup
+   - Week 5-8: Growth and maintenance (pest management, fertilizing)
+   - Week 9-12: Pre-harvest and harvest preparation
+
+4. **📈 Realistic Earnings Projection (in the farmer's currency)**
+   - Expected harvest amount (based on local yields)
+   - Market price per unit (use current Nigerian market rates if applicable)
+   - Total expected revenue
+   - Net profit after all expenses
+   - Profit margin percentage
+
+5. **🛒 Market Strategy**
+   - Best places to sell in the farm's location (local markets, cooperatives, processors)
+   - For Nigeria: mention specific markets like Mile 12, Kano markets, or local daily markets
+   - Pricing recommendations based on local competition
+   - Marketing tips for African farmers (cooperative selling, direct-to-consumer)
+
+6. **⚠️ Risk & Mitigation**
+   - 2-3 major risks specific to the farm's location/Nigeria
+   - Practical mitigation strategies (pest control, weather challenges, market fluctuation)
+   - Consider Nigerian agricultural realities (power, water access, transportation)
+
+After the plan, write a line containing only ---SUGGESTIONS--- followed by:
+
+**Suggested Follow-up Questions:**
+1. What are the most common pests for this crop in <location> and how do I prevent them organically?
+2. Can you give me a detailed week-by-week watering and fertilizer schedule for <location>'s climate?
+3. What are the best local markets in <location> to sell my produce and what prices should I expect?
+
+Replace <location> with the farm's location."""
+
+NIGERIA_PRIORITY_CROPS = """
+**PRIORITY CROPS FOR NIGERIA (Consider these first):**
+- Cassava (highest yield, multiple uses: garri, fufu, flour, starch)
+- Maize/Corn (staple food, animal feed, fast-growing)
+- Rice (high government support, import gap, strong demand)
+- Yam (traditional staple, high value)
+- Vegetables (tomatoes, peppers, onions - daily necessity, urban demand)
+- Plantain (best long-term ROI, year-round production)
+- Ginger (export value, medicinal demand)
+
+**Nigerian Market Context:**
+- Consider selling at major markets: Mile 12 (Lagos), Kano State markets, Dawanau International Grains Market, local daily markets
+- Factor in Nigerian climate zones and seasonal patterns
+- Use local farming practices combined with modern techniques
+"""
+
+DIAGNOSIS_INSTRUCTION = """You are an expert plant pathologist with extensive experience in Nigerian and West African crop diseases. Analyze the plant image you are given and provide a detailed diagnosis.
+
+**Part 1: Diagnosis Report (Markdown Format)**
+1. **Title:** A short, descriptive title for the issue
+2. **Analysis:** Identify the likely pest or disease affecting this plant
+   - Consider common pests/diseases prevalent in Nigeria and West Africa
+   - Look for signs of nutrient deficiency common in tropical soils
+3. **Symptoms:** Describe the symptoms visible in the image
+4. **Organic Treatment:** Recommend organic/natural treatment methods
+   - Prioritize locally available organic solutions (neem oil, wood ash, local herbs)
+   - Traditional Nigerian farming remedies where applicable
+5. **Chemical Treatment:** Recommend chemical treatment options if needed
+   - Suggest products commonly available in Nigerian agro-dealers
+   - Include both brand names and generic chemical names
+   - Provide dosage and safety precautions
+6. **Prevention:** Tips to prevent this issue in the future
+   - Climate-specific advice for Nigerian weather conditions
+   - Crop rotation practices suitable for African smallholder farms
+
+**IMPORTANT:** Provide your best diagnosis even if the image quality is not perfect. Focus on practical solutions Nigerian farmers can implement immediately.
+
+---SUGGESTIONS---
+
+**Part 2: Follow-up Questions**
+Suggest 3 relevant follow-up questions the user might want to ask."""
+
+KNOWLEDGE_INSTRUCTION = """You are an expert agricultural advisor with decades of farming experience in Nigeria and West Africa. Answer the user's farming question with practical, actionable advice tailored for African smallholder farmers.
+
+Provide a clear, helpful answer in 2-4 paragraphs. Focus on:
+- Practical advice Nigerian/African farmers can implement immediately
+- Location-specific recommendations (Nigerian climate zones, soil types, seasons)
+- Cost-effective solutions using locally available materials and resources
+- Both traditional African farming wisdom and modern agricultural techniques
+- Reference Nigerian crops (cassava, maize, rice, yam, vegetables, plantain) when relevant
+- Consider Nigerian agricultural realities (weather patterns, market access, smallholder constraints)
+
+Keep it conversational and easy to understand. Use simple language suitable for farmers with varying education levels."""
+
+# Per-request parts of the prompts, compiled once
+FARM_DETAILS_TEMPLATE = string.Template("""**Farm Details:**
+- Location: $location, $country
+- Available Space: $space
+- Budget: $currency $budget
+$nigerian_priority""")
+
+DIAGNOSIS_REQUEST_TEMPLATE = string.Template("Analyze this $crop_type plant image and provide a detailed diagnosis.")
+
+KNOWLEDGE_QUESTION_TEMPLATE = string.Template("Question: $query$user_context")
+
+# Numbered follow-up questions after the ---SUGGESTIONS--- marker, one per line
+SUGGESTION_RE = re.compile(r'^[ \t]*([1-5][^\r\n]*?)[ \t\r]*$', re.M)
+
 GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
-gemini_model = None
 
 if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-2.0-flash-exp')
     print("✅ Gemini API configured successfully!")
 else:
     print("⚠️  Warning: GEMINI_API_KEY not found. All AI features will be disabled.")
     print("   Please add GEMINI_API_KEY to your Replit Secrets.")
 
+@functools.lru_cache(maxsize=None)
+def get_gemini_model(system_instruction=None):
+    """Return the Gemini model for a system instruction, importing the SDK on first use"""
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_instruction)
+
 # --- DATABASE SETUP ---
-def get_db_connection():
-    conn = sqlite3.connect('yieldwise.db', check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+_sqlite_initialized = False
+DB_BUSY_TIMEOUT = 5
+
+def connect_db():
+    global _sqlite_initialized
+    # Writers wait up to DB_BUSY_TIMEOUT seconds for the lock instead of failing with "database is locked"
+    conn = sqlite3.connect('yieldwise.db', timeout=DB_BUSY_TIMEOUT, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
     conn.row_factory = sqlite3.Row
+    
+    # WAL lets readers run alongside a writer; it is stored in the database file,
+    # so it only has to be switched on once per process
+    if not _sqlite_initialized:
+        conn.execute('PRAGMA journal_mode=WAL;')
+        _sqlite_initialized = True
+    
+    # The rest are per-connection settings; SQLite ignores foreign keys unless asked
+    conn.execute('PRAGMA foreign_keys=ON;')
+    conn.execute('PRAGMA synchronous=NORMAL;')
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    conn.execute('PRAGMA cache_size=-20000;')
+    conn.execute('PRAGMA mmap_size=268435456;')
+    # Fold the WAL back into the database every ~4MB of pages so it stays small
+    conn.execute('PRAGMA wal_autocheckpoint=1000;')
     return conn
 
+# Connections stay open between requests so the open and PRAGMA setup is paid once
+DB_POOL_SIZE = 8
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def get_db_connection():
+    """Return the connection for the current request, checking one out on first use"""
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+    return g.db
+
+# Pooled connections are rarely closed, which is when SQLite would normally refresh
+# planner statistics, so PRAGMA optimize is run every DB_OPTIMIZE_EVERY requests instead
+DB_OPTIMIZE_EVERY = 1000
+_db_releases = itertools.count(1)
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    if next(_db_releases) % DB_OPTIMIZE_EVERY == 0:
+        conn.execute('PRAGMA optimize;')
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def add_column_if_missing(conn, table, column, definition):
+    """Add a column to an existing table; returns True if it had to be added"""
+    columns = [row['name'] for row in conn.execute(f'PRAGMA table_info({table});')]
+    if column in columns:
+        return False
+    conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition};')
+    return True
+
+def rebuild_with_cascade(conn, table, schema):
+    """Recreate a table whose foreign keys predate ON DELETE CASCADE, keeping its rows.
+
+    SQLite cannot alter a constraint in place, so rows are copied into a fresh
+    table built from schema; any already orphaned by earlier deletes are dropped.
+    """
+    foreign_keys = conn.execute(f'PRAGMA foreign_key_list({table});').fetchall()
+    if all(fk['on_delete'] == 'CASCADE' for fk in foreign_keys):
+        return False
+    conn.execute(f'ALTER TABLE {table} RENAME TO {table}_old;')
+    conn.execute(schema)
+    columns = ', '.join(row['name'] for row in conn.execute(f'PRAGMA table_info({table}_old);'))
+    parents_exist = ' AND '.join(f"{fk['from']} IN (SELECT {fk['to']} FROM {fk['table']})" for fk in foreign_keys)
+    conn.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_old WHERE {parents_exist};')
+    conn.execute(f'DROP TABLE {table}_old;')
+    return True
+
 def init_db():
-    conn = get_db_connection()
+    conn = connect_db()
+    
+    # Every gunicorn worker runs this at startup: the first takes the write lock for the
+    # whole migration, the others wait here and then find nothing left to do
+    conn.execute('PRAGMA busy_timeout=60000;')
+    conn.execute('BEGIN IMMEDIATE;')
     
     # Create tables
     conn.execute('CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE, password TEXT NOT NULL, name TEXT NOT NULL);')
@@ -67,28 +316,141 @@ def init_db():
         CREATE TABLE IF NOT EXISTS farm_plans (
             id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, 
             location TEXT NOT NULL, country TEXT, currency TEXT, 
-            plan_html TEXT NOT NULL, showcase_id TEXT, 
+            plan_html TEXT NOT NULL, plan_md TEXT, showcase_id TEXT, 
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, 
             FOREIGN KEY (user_id) REFERENCES users (id)
         );
     ''')
-    conn.execute('CREATE TABLE IF NOT EXISTS chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, plan_id INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (plan_id) REFERENCES farm_plans (id));')
-    conn.execute('CREATE TABLE IF NOT EXISTS diagnoses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, title TEXT NOT NULL, crop_type TEXT, report_html TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (user_id) REFERENCES users (id));')
-    conn.execute('CREATE TABLE IF NOT EXISTS diagnoses_chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, diagnosis_id INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (diagnosis_id) REFERENCES diagnoses (id));')
+    chat_history_schema = 'CREATE TABLE IF NOT EXISTS chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, plan_id INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, content_html TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (plan_id) REFERENCES farm_plans (id) ON DELETE CASCADE);'
+    conn.execute(chat_history_schema)
+    conn.execute('CREATE TABLE IF NOT EXISTS diagnoses (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, title TEXT NOT NULL, crop_type TEXT, report_html TEXT NOT NULL, report_md TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (user_id) REFERENCES users (id));')
+    diagnoses_chat_history_schema = 'CREATE TABLE IF NOT EXISTS diagnoses_chat_history (id INTEGER PRIMARY KEY AUTOINCREMENT, diagnosis_id INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, content_html TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (diagnosis_id) REFERENCES diagnoses (id) ON DELETE CASCADE);'
+    conn.execute(diagnoses_chat_history_schema)
+    conn.execute('CREATE TABLE IF NOT EXISTS llm_cache (key BLOB PRIMARY KEY, response TEXT NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);')
+    
+    # The markdown source is kept as follow-up context, which is far fewer tokens than the HTML;
+    # older rows and claimed guest plans only have HTML and fall back to it
+    add_column_if_missing(conn, 'farm_plans', 'plan_md', 'TEXT')
+    add_column_if_missing(conn, 'diagnoses', 'report_md', 'TEXT')
+    
+    # Assistant replies are stored pre-rendered so they are never converted again
+    for table in ('chat_history', 'diagnoses_chat_history'):
+        if add_column_if_missing(conn, table, 'content_html', 'TEXT'):
+            replies = conn.execute(f"SELECT id, content FROM {table} WHERE role = 'assistant'").fetchall()
+            conn.executemany(
+                f'UPDATE {table} SET content_html = ? WHERE id = ?',
+                [(render_md(reply['content']), reply['id']) for reply in replies]
+            )
+    
+    # Chat history is deleted along with its plan or diagnosis by the database
+    rebuild_with_cascade(conn, 'chat_history', chat_history_schema)
+    rebuild_with_cascade(conn, 'diagnoses_chat_history', diagnoses_chat_history_schema)
     
     # Create indexes for performance optimization
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_user_id ON farm_plans(user_id);')
+    # Composite (owner, created_at) indexes serve the ORDER BY without a sort step
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_user_created ON farm_plans(user_id, created_at DESC);')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_created_at ON farm_plans(created_at DESC);')
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_showcase_id ON farm_plans(showcase_id);')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_farm_plans_showcase_id_unique ON farm_plans(showcase_id) WHERE showcase_id IS NOT NULL;')
+    # Lets the community page read its newest 50 shared plans straight off an index
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_showcased_created ON farm_plans(created_at DESC) WHERE showcase_id IS NOT NULL;')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_farm_plans_country ON farm_plans(country);')
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_plan_id ON chat_history(plan_id);')
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_user_id ON diagnoses(user_id);')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_chat_history_plan_created ON chat_history(plan_id, created_at);')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_user_created ON diagnoses(user_id, created_at DESC);')
     conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_created_at ON diagnoses(created_at DESC);')
-    conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_chat_history_diagnosis_id ON diagnoses_chat_history(diagnosis_id);')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_diagnoses_chat_history_diagnosis_created ON diagnoses_chat_history(diagnosis_id, created_at);')
+    
+    # Drop single-column indexes superseded by the composite ones above
+    for index in ('idx_farm_plans_user_id', 'idx_farm_plans_showcase_id', 'idx_chat_history_plan_id',
+                  'idx_diagnoses_user_id', 'idx_diagnoses_chat_history_diagnosis_id'):
+        conn.execute(f'DROP INDEX IF EXISTS {index};')
+    
+    # Trigram full-text index on plan locations, kept in sync by triggers
+    fts_exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'farm_plans_fts'").fetchone()
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS farm_plans_fts USING fts5(location, content='farm_plans', content_rowid='id', tokenize='trigram');")
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS farm_plans_fts_insert AFTER INSERT ON farm_plans BEGIN
+            INSERT INTO farm_plans_fts (rowid, location) VALUES (new.id, new.location);
+        END;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS farm_plans_fts_delete AFTER DELETE ON farm_plans BEGIN
+            INSERT INTO farm_plans_fts (farm_plans_fts, rowid, location) VALUES ('delete', old.id, old.location);
+        END;
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS farm_plans_fts_update AFTER UPDATE OF location ON farm_plans BEGIN
+            INSERT INTO farm_plans_fts (farm_plans_fts, rowid, location) VALUES ('delete', old.id, old.location);
+            INSERT INTO farm_plans_fts (rowid, location) VALUES (new.id, new.location);
+        END;
+    ''')
+    if not fts_exists:
+        conn.execute("INSERT INTO farm_plans_fts (farm_plans_fts) VALUES ('rebuild');")
+    
+    # Expired cached AI responses are never read again
+    conn.execute(f"DELETE FROM llm_cache WHERE created_at <= datetime('now', '-{LLM_CACHE_HOURS} hours');")
     
     conn.commit()
+    
+    # Refresh planner statistics so the indexes above are chosen; sampling keeps it fast on big tables
+    conn.execute('PRAGMA analysis_limit=1000;')
+    conn.execute('ANALYZE;')
     conn.close()
 
+def get_user_history(user_id):
+    """Fetch a user's plans and diagnoses, newest first, in a single round-trip"""
+    rows = get_db_connection().execute('''
+        SELECT 'plan' AS kind, id, location, country, currency, showcase_id,
+               NULL AS title, NULL AS crop_type, created_at
+        FROM farm_plans WHERE user_id = ?
+        UNION ALL
+        SELECT 'diagnosis', id, NULL, NULL, NULL, NULL, title, crop_type, created_at
+        FROM diagnoses WHERE user_id = ?
+        ORDER BY created_at DESC
+    ''', (user_id, user_id)).fetchall()
+    plans = [row for row in rows if row['kind'] == 'plan']
+    diagnoses = [row for row in rows if row['kind'] == 'diagnosis']
+    return plans, diagnoses
+
+# Column lists, so the large HTML blobs are only read where they are used
+PLAN_LIST_COLUMNS = 'id, location, country, currency, showcase_id, created_at'
+PLAN_COLUMNS = 'id, user_id, location, country, currency, plan_html, showcase_id, created_at'
+DIAGNOSIS_COLUMNS = 'id, user_id, title, crop_type, report_html, created_at'
+
+# A record's chat as a single JSON array column, so it loads in the same query as the record
+PLAN_CHAT_HISTORY = """(SELECT json_group_array(json_object('role', role, 'content', content, 'content_html', content_html))
+    FROM (SELECT role, content, content_html FROM chat_history WHERE plan_id = farm_plans.id ORDER BY created_at, id)) AS chat_history"""
+DIAGNOSIS_CHAT_HISTORY = """(SELECT json_group_array(json_object('role', role, 'content', content, 'content_html', content_html))
+    FROM (SELECT role, content, content_html FROM diagnoses_chat_history WHERE diagnosis_id = diagnoses.id ORDER BY created_at, id)) AS chat_history"""
+
+# Follow-up prompts only replay the latest turns, so they stop growing with the chat
+FOLLOW_UP_HISTORY_TURNS = 10
+PLAN_RECENT_CHAT = f"""(SELECT json_group_array(json_object('role', role, 'content', content))
+    FROM (SELECT role, content FROM (SELECT role, content, created_at, id FROM chat_history WHERE plan_id = farm_plans.id
+          ORDER BY created_at DESC, id DESC LIMIT {FOLLOW_UP_HISTORY_TURNS}) ORDER BY created_at, id)) AS chat_history"""
+DIAGNOSIS_RECENT_CHAT = f"""(SELECT json_group_array(json_object('role', role, 'content', content))
+    FROM (SELECT role, content FROM (SELECT role, content, created_at, id FROM diagnoses_chat_history WHERE diagnosis_id = diagnoses.id
+          ORDER BY created_at DESC, id DESC LIMIT {FOLLOW_UP_HISTORY_TURNS}) ORDER BY created_at, id)) AS chat_history"""
+
+def get_owned_plan(plan_id, columns='id'):
+    """Fetch columns of a farm plan belonging to the current user, at most once per request"""
+    owned_plans = g.setdefault('owned_plans', {})
+    if (plan_id, columns) not in owned_plans:
+        owned_plans[plan_id, columns] = get_db_connection().execute(
+            f'SELECT {columns} FROM farm_plans WHERE id = ? AND user_id = ?',
+            (plan_id, current_user.id)
+        ).fetchone()
+    return owned_plans[plan_id, columns]
+
+def get_owned_diagnosis(diagnosis_id, columns='id'):
+    """Fetch columns of a diagnosis belonging to the current user, at most once per request"""
+    owned_diagnoses = g.setdefault('owned_diagnoses', {})
+    if (diagnosis_id, columns) not in owned_diagnoses:
+        owned_diagnoses[diagnosis_id, columns] = get_db_connection().execute(
+            f'SELECT {columns} FROM diagnoses WHERE id = ? AND user_id = ?',
+            (diagnosis_id, current_user.id)
+        ).fetchone()
+    return owned_diagnoses[diagnosis_id, columns]
+
 # --- HELPER FUNCTIONS ---
 @app.template_filter('dateformat')
 def dateformat(value, format='%Y-%m-%d'):
@@ -100,168 +462,316 @@ def dateformat(value, format='%Y-%m-%d'):
     return value
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return filename.lower().endswith(ALLOWED_SUFFIXES)
+
+def get_json_body():
+    """Parse the request's JSON object once; a missing or malformed body is treated as empty"""
+    if 'json' not in g:
+        data = request.get_json(silent=True)
+        g.json = data if isinstance(data, dict) else {}
+    return g.json
+
+def run_blocking(func, *args, **kwargs):
+    """Run CPU-heavy work on a real OS thread when serving under gevent.
+
+    Gemini calls already yield to other greenlets while waiting on the network,
+    but PDF layout, image resizing and password hashing would otherwise stall the whole worker.
+    """
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return func(*args, **kwargs)
+    if not monkey.is_module_patched('threading'):
+        return func(*args, **kwargs)
+    return get_hub().threadpool.apply(func, args, kwargs)
+
+@functools.lru_cache(maxsize=512)
+def render_md(text):
+    """Render GitHub-flavoured markdown to HTML, reusing the result for text seen recently.
+
+    cmark is C and far faster than the pure-Python markdown package; its safe
+    default also drops raw HTML from the AI's output instead of passing it through.
+    """
+    return cmarkgfm.github_flavored_markdown_to_html(text)
+
+# --- HTTP CACHING HELPERS ---
+def make_etag(*parts):
+    """Short validator for a response that depends only on the given values"""
+    return hashlib.blake2b(':'.join(map(str, parts)).encode(), digest_size=8).hexdigest()
+
+def is_not_modified(etag):
+    """Whether the client already holds this version; Flask-Compress suffixes ETags with the encoding"""
+    return any(request.if_none_match.contains(variant) for variant in (etag, f'{etag}:br', f'{etag}:gzip'))
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+def with_etag(response, etag, max_age=None, public=False):
+    """Tag a response; without max_age the client revalidates on every use"""
+    response.set_etag(etag)
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    if max_age:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+# --- PDF HELPERS ---
+PDF_CSS = """
+    body { font-family: sans-serif; font-size: 12px; }
+    h1, h2, h3 { color: #2c6b4f; }
+    table { border-collapse: collapse; width: 100%; margin: 1em 0; }
+    th, td { border: 1px solid #ddd; text-align: left; padding: 8px; }
+    th { background-color: #f2f2f2; }
+    .footer { text-align: center; font-size: 10px; color: #777; margin-top: 2em; }
+"""
+
+@functools.lru_cache(maxsize=None)
+def get_pdf_font_config():
+    """Build WeasyPrint's font configuration once per process"""
+    from weasyprint.text.fonts import FontConfiguration
+    return FontConfiguration()
+
+@functools.lru_cache(maxsize=None)
+def get_pdf_stylesheet():
+    """Parse the PDF stylesheet once per process instead of once per download"""
+    from weasyprint import CSS
+    return CSS(string=PDF_CSS, font_config=get_pdf_font_config())
+
+PDF_CACHE_DIR = os.path.join(app.instance_path, 'pdf_cache')
+
+def pdf_cache_path(plan):
+    """Cache file for a plan's PDF; plans never change after creation"""
+    return os.path.join(PDF_CACHE_DIR, f"plan_{plan['id']}_{dateformat(plan['created_at'], '%Y%m%d%H%M%S')}.pdf")
+
+# --- STREAMING HELPERS ---
+SSE_DONE = "data: [DONE]\n\n"
+
+def sse_event(payload):
+    """Format a payload as a single Server-Sent Events message"""
+    return f"data: {app.json.dumps(payload)}\n\n"
+
+def sse_response(events):
+    """Wrap an event generator in an unbuffered text/event-stream response"""
+    response = Response(stream_with_context(events), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def relay_chunks(stream):
+    """Forward text chunks from an AI generator as SSE events and return its result"""
+    while True:
+        try:
+            chunk = next(stream)
+        except StopIteration as done:
+            return done.value
+        yield sse_event({'chunk': chunk})
+
+def gzip_stream(chunks):
+    """Gzip text chunks as they are produced; Flask-Compress would buffer the whole stream"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def drain(stream):
+    """Run an AI generator to completion and return its result"""
+    while True:
+        try:
+            next(stream)
+        except StopIteration as done:
+            return done.value
 
 # --- USER CLASS & LOADER ---
+# scrypt costs about the same CPU per login as 260k PBKDF2 rounds (a quarter of
+# Werkzeug's PBKDF2 default) but is memory-hard, so it is far costlier to brute-force
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+
 class User(UserMixin):
     def __init__(self, id, email, password, name):
         self.id, self.email, self.password, self.name = id, email, password, name
 
+# Flask-Login loads the user on every request; users never change, so keep them briefly
+user_cache = TTLCache(maxsize=10_000, ttl=60)
+
 @login_manager.user_loader
+@cached(user_cache, lock=threading.Lock())
 def load_user(user_id):
     conn = get_db_connection()
-    user_data = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
+    user_data = conn.execute('SELECT id, email, password, name FROM users WHERE id = ?', (user_id,)).fetchone()
     if user_data: return User(user_data['id'], user_data['email'], user_data['password'], user_data['name'])
     return None
 
 # --- CORE AI FUNCTIONS (ALL USE GEMINI) ---
+# Identical prompts (common locations and budgets, re-uploaded photos) reuse the stored answer
+LLM_CACHE_HOURS = 6
+
+def llm_cache_key(prompt, system_instruction):
+    """Hash a prompt (text or a list of text and image parts) with its instruction"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in [system_instruction or '', *(prompt if isinstance(prompt, list) else [prompt])]:
+        if isinstance(part, dict):
+            digest.update(part['mime_type'].encode())
+            digest.update(part['data'])
+        else:
+            digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.digest()
+
+# Cached prompts currently being generated in this process, mapped to an Event set when they finish
+_inflight_prompts = {}
+_inflight_lock = threading.Lock()
+INFLIGHT_WAIT_SECONDS = 120
+
+def get_cached_response(conn, key):
+    row = conn.execute(
+        'SELECT response FROM llm_cache WHERE key = ? AND created_at > datetime(\'now\', ?)',
+        (key, f'-{LLM_CACHE_HOURS} hours')
+    ).fetchone()
+    return row['response'] if row else None
+
+def stream_gemini_text(prompt, system_instruction=None, cached=False):
+    """Yield text chunks from a streaming Gemini call and return the full text.
+
+    With cached=True a response stored in llm_cache within LLM_CACHE_HOURS is
+    replayed as a single chunk, and new responses are stored there. A request
+    for a prompt that is already being generated waits for that call instead
+    of starting another one.
+    """
+    owns_inflight = False
+    if cached:
+        key = llm_cache_key(prompt, system_instruction)
+        conn = get_db_connection()
+        hit = get_cached_response(conn, key)
+        if hit is None:
+            with _inflight_lock:
+                done = _inflight_prompts.get(key)
+                if done is None:
+                    _inflight_prompts[key] = threading.Event()
+                    owns_inflight = True
+            if done is not None:
+                done.wait(INFLIGHT_WAIT_SECONDS)
+                # Falls through to its own call if the other one failed or timed out
+                hit = get_cached_response(conn, key)
+        if hit is not None:
+            yield hit
+            return hit
+    
+    try:
+        parts = []
+        for chunk in get_gemini_model(system_instruction).generate_content(prompt, stream=True):
+            parts.append(chunk.text)
+            yield chunk.text
+        text = ''.join(parts)
+        
+        if cached and text:
+            # Expired entries are dropped here too, so long-running workers keep the table small
+            conn.execute('DELETE FROM llm_cache WHERE created_at <= datetime(\'now\', ?)', (f'-{LLM_CACHE_HOURS} hours',))
+            conn.execute('INSERT OR REPLACE INTO llm_cache (key, response) VALUES (?, ?)', (key, text))
+            conn.commit()
+        return text
+    finally:
+        if owns_inflight:
+            with _inflight_lock:
+                _inflight_prompts.pop(key).set()
+
 def generate_farm_plan(location, space, budget, country, currency):
-    """Generate farm business plan using Gemini AI"""
+    """Generate farm business plan using Gemini AI.
+
+    Yields markdown chunks as they stream in and returns (plan_text, plan_html, suggestions).
+    """
     try:
-        if not gemini_model:
-            return "<p class='error-message'>AI service is currently unavailable. Please contact support to enable Gemini API.</p>", []
+        if not GOOGLE_API_KEY:
+            return None, "<p class='error-message'>AI service is currently unavailable. Please contact support to enable Gemini API.</p>", []
         
         # Prioritize Nigerian crops for Nigerian users
         nigerian_priority = ""
         if country == "Nigeria" or "nigeria" in location.lower():
-            nigerian_priority = """
-**PRIORITY CROPS FOR NIGERIA (Consider these first):**
-- Cassava (highest yield, multiple uses: garri, fufu, flour, starch)
-- Maize/Corn (staple food, animal feed, fast-growing)
-- Rice (high government support, import gap, strong demand)
-- Yam (traditional staple, high value)
-- Vegetables (tomatoes, peppers, onions - daily necessity, urban demand)
-- Plantain (best long-term ROI, year-round production)
-- Ginger (export value, medicinal demand)
-
-**Nigerian Market Context:**
-- Consider selling at major markets: Mile 12 (Lagos), Kano State markets, Dawanau International Grains Market, local daily markets
-- Factor in Nigerian climate zones and seasonal patterns
-- Use local farming practices combined with modern techniques
-"""
-            
-        master_prompt = f"""You are an expert Nigerian agronomist and agricultural business consultant with deep knowledge of West African farming. Create a comprehensive farm business plan.
-
-**Farm Details:**
-- Location: {location}, {country}
-- Available Space: {space}
-- Budget: {currency} {budget}
-
-{nigerian_priority}
-
-**Instructions:**
-Generate a detailed business plan in markdown format with these sections:
-
-1. **🌱 Recommended Crop**
-   - Choose ONE highly profitable, fast-growing crop ideal for {location}
-   - Prioritize crops proven successful for Nigerian/African smallholder farmers
-   - Explain why this crop is perfect for their location, budget, and local market demand
-
-2. **💰 Budget Breakdown (in {currency})**
-   - Create a detailed markdown table breaking down the EXACT budget
-   - Include: seeds/seedlings, fertilizer (organic & chemical options), tools, water/irrigation, labor, transportation, miscellaneous
-   - Show total = {budget}
-   - Use realistic local market prices
-
-3. **🗓️ 90-Day Action Plan**
-   - Week 1-2: Land preparation and initial steps (consider Nigerian weather patterns)
-   - Week 3-4: Planting and setup
-   - Week 5-8: Growth and maintenance (pest management, fertilizing)
-   - Week 9-12: Pre-harvest and harvest preparation
-
-4. **📈 Realistic Earnings Projection (in {currency})**
-   - Expected harvest amount (based on local yields)
-   - Market price per unit (use current Nigerian market rates if applicable)
-   - Total expected revenue
-   - Net profit after all expenses
-   - Profit margin percentage
-
-5. **🛒 Market Strategy**
-   - Best places to sell in {location} (local markets, cooperatives, processors)
-   - For Nigeria: mention specific markets like Mile 12, Kano markets, or local daily markets
-   - Pricing recommendations based on local competition
-   - Marketing tips for African farmers (cooperative selling, direct-to-consumer)
-
-6. **⚠️ Risk & Mitigation**
-   - 2-3 major risks specific to {location}/Nigeria
-   - Practical mitigation strategies (pest control, weather challenges, market fluctuation)
-   - Consider Nigerian agricultural realities (power, water access, transportation)
-
----SUGGESTIONS---
-
-**Suggested Follow-up Questions:**
-1. What are the most common pests for this crop in {location} and how do I prevent them organically?
-2. Can you give me a detailed week-by-week watering and fertilizer schedule for {location}'s climate?
-3. What are the best local markets in {location} to sell my produce and what prices should I expect?"""
-
-        response = gemini_model.generate_content(master_prompt)
-        full_response = response.text
+            nigerian_priority = NIGERIA_PRIORITY_CROPS
+        
+        farm_prompt = FARM_DETAILS_TEMPLATE.substitute(
+            location=location, country=country, space=space,
+            currency=currency, budget=budget, nigerian_priority=nigerian_priority
+        )
+        
+        full_response = yield from stream_gemini_text(farm_prompt, FARM_PLAN_INSTRUCTION, cached=True)
         
         if "---SUGGESTIONS---" in full_response:
             plan_text, suggestions_text = full_response.split("---SUGGESTIONS---", 1)
-            suggestions = [s.strip() for s in suggestions_text.strip().split('\n') if s.strip() and any(s.strip().startswith(str(i)) for i in range(1, 6))]
+            suggestions = SUGGESTION_RE.findall(suggestions_text)
         else:
             plan_text, suggestions = full_response, []
         
-        plan_html = markdown.markdown(plan_text, extensions=['tables'])
-        return plan_html, suggestions[:3]
+        plan_html = render_md(plan_text)
+        return plan_text, plan_html, suggestions[:3]
     except Exception as e:
         print(f"Error in generate_farm_plan: {e}")
-        return "<p class='error-message'>Error: Could not generate the plan. Please try again.</p>", []
+        return None, "<p class='error-message'>Error: Could not generate the plan. Please try again.</p>", []
 
-def diagnose_plant_issue(image_file, crop_type):
-    """Diagnose plant disease using Gemini Vision AI"""
+def prepare_plant_image(image_bytes):
+    """Return the image bytes and mime type to send to Gemini as a JPEG of at most 1024px.
+
+    Gemini scales images down itself, so larger uploads only slow the request.
+    JPEGs that are already small enough are passed through without decoding.
+    """
+    from PIL import Image, ImageOps
+    img = Image.open(io.BytesIO(image_bytes))  # reads the header, not the pixels
+    upright = img.getexif().get(0x0112, 1) == 1  # EXIF Orientation
+    if img.format == 'JPEG' and upright and max(img.size) <= 1024:
+        return image_bytes, 'image/jpeg'
+    
+    # Re-encoding drops the Orientation tag, so rotate phone photos upright first
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((1024, 1024), Image.LANCZOS)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # JPEG has no alpha; flatten onto white instead of letting it turn black
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, 'JPEG', quality=85, optimize=True)
+    return buffer.getvalue(), 'image/jpeg'
+
+def diagnose_plant_issue(image_bytes, crop_type):
+    """Diagnose plant disease using Gemini Vision AI.
+
+    Yields markdown chunks as they stream in and returns (title, report_text, report_html, suggestions).
+    """
     try:
-        if not gemini_model:
-            return "Error", "<p class='error-message'>AI service is currently unavailable. Please contact support to enable Gemini API.</p>", []
+        if not GOOGLE_API_KEY:
+            return "Error", None, "<p class='error-message'>AI service is currently unavailable. Please contact support to enable Gemini API.</p>", []
             
-        img = Image.open(image_file)
+        # Decoding and resizing a phone photo is CPU work that would stall other requests
+        image_data, image_mime_type = run_blocking(prepare_plant_image, image_bytes)
         prompt_parts = [
-            f"""Analyze this {crop_type} plant image and provide a detailed diagnosis. You are an expert plant pathologist with extensive experience in Nigerian and West African crop diseases.
-
-**Part 1: Diagnosis Report (Markdown Format)**
-1. **Title:** A short, descriptive title for the issue
-2. **Analysis:** Identify the likely pest or disease affecting this plant
-   - Consider common pests/diseases prevalent in Nigeria and West Africa
-   - Look for signs of nutrient deficiency common in tropical soils
-3. **Symptoms:** Describe the symptoms visible in the image
-4. **Organic Treatment:** Recommend organic/natural treatment methods
-   - Prioritize locally available organic solutions (neem oil, wood ash, local herbs)
-   - Traditional Nigerian farming remedies where applicable
-5. **Chemical Treatment:** Recommend chemical treatment options if needed
-   - Suggest products commonly available in Nigerian agro-dealers
-   - Include both brand names and generic chemical names
-   - Provide dosage and safety precautions
-6. **Prevention:** Tips to prevent this issue in the future
-   - Climate-specific advice for Nigerian weather conditions
-   - Crop rotation practices suitable for African smallholder farms
-
-**IMPORTANT:** Provide your best diagnosis even if the image quality is not perfect. Focus on practical solutions Nigerian farmers can implement immediately.
-
----SUGGESTIONS---
-
-**Part 2: Follow-up Questions**
-Suggest 3 relevant follow-up questions the user might want to ask.""",
-            img,
+            DIAGNOSIS_REQUEST_TEMPLATE.substitute(crop_type=crop_type),
+            {'mime_type': image_mime_type, 'data': image_data},
         ]
         
-        response = gemini_model.generate_content(prompt_parts)
-        full_response = response.text
+        full_response = yield from stream_gemini_text(prompt_parts, DIAGNOSIS_INSTRUCTION, cached=True)
         
         if "---SUGGESTIONS---" in full_response:
             report_text, suggestions_text = full_response.split("---SUGGESTIONS---", 1)
             title_line = report_text.strip().split('\n')[0]
             title = title_line.replace('**Title:**', '').replace('#', '').strip() or f"Diagnosis for {crop_type}"
-            suggestions = [s.strip() for s in suggestions_text.strip().split('\n') if s.strip() and any(s.strip().startswith(str(i)) for i in range(1, 6))]
+            suggestions = SUGGESTION_RE.findall(suggestions_text)
         else:
             report_text, title, suggestions = full_response, f"Diagnosis for {crop_type}", []
         
-        report_html = markdown.markdown(report_text, extensions=['tables'])
-        return title, report_html, suggestions[:3]
+        report_html = render_md(report_text)
+        return title, report_text, report_html, suggestions[:3]
     except Exception as e:
         print(f"Error in diagnose_plant_issue: {e}")
-        return "Error", "<p class='error-message'>Sorry, an error occurred while analyzing the image.</p>", []
+        return "Error", None, "<p class='error-message'>Sorry, an error occurred while analyzing the image.</p>", []
 
 # --- WEBSITE ROUTES ---
 @app.route('/')
@@ -279,28 +789,25 @@ def register():
             return redirect(url_for('register'))
         
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        user = conn.execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone()
         if user:
             flash('Email address already exists.', 'error')
-            conn.close()
             return redirect(url_for('register'))
         
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        hashed_password = run_blocking(generate_password_hash, password, method=PASSWORD_HASH_METHOD)
         cursor = conn.cursor()
         cursor.execute('INSERT INTO users (name, email, password) VALUES (?, ?, ?)', (name, email, hashed_password))
         new_user_id = cursor.lastrowid
-        conn.commit()
         
-        if 'guest_plan' in session:
-            guest_plan = session['guest_plan']
+        # The account and any guest plan it claims are saved in one transaction
+        guest_plan = session.pop('guest_plan', None)
+        if guest_plan:
             conn.execute(
                 'INSERT INTO farm_plans (user_id, location, country, currency, plan_html) VALUES (?, ?, ?, ?, ?)',
                 (new_user_id, guest_plan['location'], guest_plan['country'], guest_plan['currency'], guest_plan['plan_html'])
             )
-            conn.commit()
-            session.pop('guest_plan', None)
+        conn.commit()
         
-        conn.close()
         flash('Registration successful! Please log in.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -314,10 +821,16 @@ def login():
             return redirect(url_for('login'))
         
         conn = get_db_connection()
-        user_data = conn.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-        conn.close()
+        user_data = conn.execute('SELECT id, email, password, name FROM users WHERE email = ?', (email,)).fetchone()
         
-        if user_data and check_password_hash(user_data['password'], password):
+        if user_data and run_blocking(check_password_hash, user_data['password'], password):
+            # Move hashes made with the old default cost over on the next login
+            if not user_data['password'].startswith(PASSWORD_HASH_METHOD + '$'):
+                conn.execute(
+                    'UPDATE users SET password = ? WHERE id = ?',
+                    (run_blocking(generate_password_hash, password, method=PASSWORD_HASH_METHOD), user_data['id'])
+                )
+                conn.commit()
             user = User(user_data['id'], user_data['email'], user_data['password'], user_data['name'])
             login_user(user)
             return redirect(url_for('dashboard'))
@@ -335,29 +848,20 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = get_db_connection()
-    plans = conn.execute('SELECT * FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    diagnoses = conn.execute('SELECT * FROM diagnoses WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    conn.close()
+    plans, diagnoses = get_user_history(current_user.id)
     return render_template('dashboard.html', plans=plans, diagnoses=diagnoses)
 
 @app.route('/diagnostician', methods=['GET'])
 @login_required
 def diagnostician():
-    conn = get_db_connection()
-    plans = conn.execute('SELECT * FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    diagnoses = conn.execute('SELECT * FROM diagnoses WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    conn.close()
+    plans, diagnoses = get_user_history(current_user.id)
     return render_template('diagnostician.html', plans=plans, diagnoses=diagnoses)
 
 @app.route('/analytics')
 @login_required
 def analytics():
-    conn = get_db_connection()
-    plans = conn.execute('SELECT * FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    diagnoses = conn.execute('SELECT * FROM diagnoses WHERE user_id = ? ORDER BY created_at DESC', (current_user.id,)).fetchall()
-    conn.close()
-    plans_data = [dict(p) for p in plans]
+    plans, diagnoses = get_user_history(current_user.id)
+    plans_data = [{'location': p['location'], 'created_at': p['created_at']} for p in plans]
     return render_template('analytics.html', plans=plans, diagnoses=diagnoses, plans_data=plans_data)
 
 @app.route('/resources')
@@ -379,7 +883,6 @@ def knowledge_base():
             'SELECT location, country FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
             (current_user.id,)
         ).fetchone()
-        conn.close()
         
         if recent_plan:
             user_location = f"{recent_plan['location']}, {recent_plan['country']}"
@@ -391,14 +894,13 @@ def community_showcase():
     """Community showcase - available to all users"""
     conn = get_db_connection()
     public_showcases = conn.execute('''
-        SELECT p.*, u.name as user_name 
+        SELECT p.location, p.country, p.showcase_id, p.created_at, u.name as user_name 
         FROM farm_plans p 
         JOIN users u ON p.user_id = u.id 
         WHERE p.showcase_id IS NOT NULL 
         ORDER BY p.created_at DESC 
         LIMIT 50
     ''').fetchall()
-    conn.close()
     return render_template('community_showcase.html', public_showcases=public_showcases)
 
 @app.route('/showcase/<showcase_id>')
@@ -406,54 +908,66 @@ def showcase(showcase_id):
     """View public showcase"""
     conn = get_db_connection()
     plan = conn.execute(
-        'SELECT p.*, u.name as user_name FROM farm_plans p JOIN users u ON p.user_id = u.id WHERE showcase_id = ?',
+        'SELECT p.id, p.location, p.plan_html, p.created_at, u.name as user_name FROM farm_plans p JOIN users u ON p.user_id = u.id WHERE showcase_id = ?',
         (showcase_id,)
     ).fetchone()
-    conn.close()
     if plan is None: 
         abort(404)
-    return render_template('showcase.html', plan=plan)
+    
+    # Plans never change, but the page header depends on who is viewing it
+    etag = make_etag(plan['id'], plan['created_at'], current_user.get_id())
+    if is_not_modified(etag):
+        return not_modified(etag)
+    response = make_response(render_template('showcase.html', plan=plan))
+    if current_user.is_authenticated:
+        return with_etag(response, etag)
+    # Anonymous copies are identical for everyone, so shared caches may keep them
+    return with_etag(response, etag, max_age=600, public=True)
 
 @app.route('/download_pdf/<int:plan_id>')
 @login_required
 def download_pdf(plan_id):
     """Download plan as PDF"""
-    conn = get_db_connection()
-    plan = conn.execute('SELECT * FROM farm_plans WHERE id = ? AND user_id = ?', (plan_id, current_user.id)).fetchone()
-    conn.close()
+    plan = get_owned_plan(plan_id, 'id, created_at')
     
     if plan is None: 
         return abort(404)
     
-    html_for_pdf = f"""
-    <html><head><style>
-        body {{ font-family: sans-serif; font-size: 12px; }} 
-        h1, h2, h3 {{ color: #2c6b4f; }}
-        table {{ border-collapse: collapse; width: 100%; margin: 1em 0; }} 
-        th, td {{ border: 1px solid #ddd; text-align: left; padding: 8px; }}
-        th {{ background-color: #f2f2f2; }} 
-        .footer {{ text-align: center; font-size: 10px; color: #777; margin-top: 2em; }}
-    </style></head><body>
-        <h1>Farm Plan for {plan['location']}</h1>
-        <p><strong>Prepared for:</strong> {current_user.name}</p>
-        <hr>
-        {plan['plan_html']}
-        <div class="footer"><p>Generated by YieldWise AI</p></div>
-    </body></html>
-    """
+    etag = make_etag(plan['id'], plan['created_at'])
+    if is_not_modified(etag):
+        return not_modified(etag)
     
-    pdf_bytes = HTML(string=html_for_pdf).write_pdf()
-    response = make_response(pdf_bytes)
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename=YieldWise_Plan_{plan["id"]}.pdf'
-    return response
+    # The plan body is only read when the PDF has to be rendered
+    cache_path = pdf_cache_path(plan)
+    if not os.path.exists(cache_path):
+        plan = get_owned_plan(plan_id, 'id, location, country, currency, plan_html, created_at')
+        html_for_pdf = render_template('plan_pdf.html', plan=plan, user_name=current_user.name)
+        from weasyprint import HTML
+        pdf_bytes = run_blocking(
+            HTML(string=html_for_pdf).write_pdf,
+            stylesheets=[get_pdf_stylesheet()], font_config=get_pdf_font_config()
+        )
+        
+        # Write via a temp file so concurrent workers never read a partial PDF
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{secrets.token_hex(8)}.tmp"
+        with open(tmp_path, 'wb') as cached:
+            cached.write(pdf_bytes)
+        os.replace(tmp_path, cache_path)
+    
+    # Streamed from the cache file rather than held in memory
+    response = send_file(
+        cache_path, mimetype='application/pdf', as_attachment=True,
+        download_name=f'YieldWise_Plan_{plan["id"]}.pdf', etag=False, conditional=False
+    )
+    return with_etag(response, etag, max_age=3600)
 
 # --- API ROUTES ---
 @app.route('/api/generate', methods=['POST'])
 @limiter.limit("3 per day", key_func=lambda: current_user.id if current_user.is_authenticated else get_remote_address)
 def api_generate():
     """Generate farm plan using Gemini AI"""
-    data = request.get_json()
+    data = get_json_body()
     
     if not all(k in data for k in ['location', 'space', 'budget', 'country', 'currency']):
         return jsonify({'error': 'Missing required fields'}), 400
@@ -471,20 +985,21 @@ def api_generate():
     if len(data['space'].strip()) < 5:
         return jsonify({'error': 'Please provide more details about your available space'}), 400
     
-    plan_html, suggestions = generate_farm_plan(
-        data['location'], data['space'], data['budget'], data['country'], data['currency']
-    )
-    
-    if "error-message" in plan_html: 
-        return jsonify({'error': plan_html}), 500
-    
-    # Handle guest users
+    # Handle guest users: their plan lives in the session cookie, which is sent
+    # with the response headers, so it has to be complete before we reply
     if not current_user.is_authenticated:
         if session.get('free_plan_used'):
             return jsonify({
                 'error': '<p class="error-message">Free plan already used. Please register to continue using YieldWise AI!</p>'
             }), 429
         
+        _, plan_html, suggestions = drain(generate_farm_plan(
+            data['location'], data['space'], data['budget'], data['country'], data['currency']
+        ))
+        
+        if "error-message" in plan_html: 
+            return jsonify({'error': plan_html}), 500
+        
         session['free_plan_used'] = True
         session['guest_plan'] = {
             'plan_html': plan_html,
@@ -494,24 +1009,39 @@ def api_generate():
         }
         return jsonify({'plan': plan_html, 'plan_id': None, 'suggestions': suggestions})
     
-    # Save for logged-in users
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO farm_plans (user_id, location, country, currency, plan_html) VALUES (?, ?, ?, ?, ?)',
-        (current_user.id, data['location'], data['country'], data['currency'], plan_html)
-    )
-    plan_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    # Stream for logged-in users and save once generation completes
+    user_id = current_user.id
+    
+    def events():
+        plan_md, plan_html, suggestions = yield from relay_chunks(generate_farm_plan(
+            data['location'], data['space'], data['budget'], data['country'], data['currency']
+        ))
+        
+        if "error-message" in plan_html:
+            yield sse_event({'error': plan_html})
+        else:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                'INSERT INTO farm_plans (user_id, location, country, currency, plan_html, plan_md) VALUES (?, ?, ?, ?, ?, ?)',
+                (user_id, data['location'], data['country'], data['currency'], plan_html, plan_md)
+            )
+            plan_id = cursor.lastrowid
+            conn.commit()
+            yield sse_event({'plan': plan_html, 'plan_id': plan_id, 'suggestions': suggestions})
+        yield SSE_DONE
     
-    return jsonify({'plan': plan_html, 'plan_id': plan_id, 'suggestions': suggestions})
+    return sse_response(events())
 
 @app.route('/api/diagnose', methods=['POST'])
 @login_required
 @limiter.limit("3 per day")
 def api_diagnose():
     """Diagnose plant disease using Gemini Vision AI"""
+    # Check upload size (5MB limit) from the header, before the body is parsed
+    if request.content_length and request.content_length > 5 * 1024 * 1024:
+        return jsonify({'error': 'Image size must be less than 5MB'}), 413
+    
     if 'plant_image' not in request.files or 'crop_type' not in request.form:
         return jsonify({'error': 'Missing file or crop type'}), 400
     
@@ -523,36 +1053,35 @@ def api_diagnose():
     if len(crop_type.strip()) < 2:
         return jsonify({'error': 'Crop type must be at least 2 characters'}), 400
     
-    # Check file size (5MB limit)
-    file.seek(0, 2)
-    file_size = file.tell()
-    file.seek(0)
-    
-    if file_size > 5 * 1024 * 1024:
-        return jsonify({'error': 'Image size must be less than 5MB'}), 400
-    
     if file and allowed_file(file.filename):
-        title, report_html, suggestions = diagnose_plant_issue(file, crop_type)
-        
-        if "Error" in title: 
-            return jsonify({'error': report_html}), 500
+        user_id = current_user.id
+        # Read the upload now; the request stream can be closed once the response starts
+        image_bytes = file.read()
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            'INSERT INTO diagnoses (user_id, title, crop_type, report_html) VALUES (?, ?, ?, ?)',
-            (current_user.id, title, crop_type, report_html)
-        )
-        diagnosis_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        def events():
+            title, report_md, report_html, suggestions = yield from relay_chunks(diagnose_plant_issue(image_bytes, crop_type))
+            
+            if "Error" in title:
+                yield sse_event({'error': report_html})
+            else:
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                cursor.execute(
+                    'INSERT INTO diagnoses (user_id, title, crop_type, report_html, report_md) VALUES (?, ?, ?, ?, ?)',
+                    (user_id, title, crop_type, report_html, report_md)
+                )
+                diagnosis_id = cursor.lastrowid
+                conn.commit()
+                
+                yield sse_event({
+                    'title': title,
+                    'diagnosis': report_html,
+                    'suggestions': suggestions,
+                    'diagnosis_id': diagnosis_id
+                })
+            yield SSE_DONE
         
-        return jsonify({
-            'title': title,
-            'diagnosis': report_html,
-            'suggestions': suggestions,
-            'diagnosis_id': diagnosis_id
-        })
+        return sse_response(events())
     else:
         return jsonify({'error': 'Invalid file type. Please upload PNG, JPG, or JPEG'}), 400
 
@@ -560,7 +1089,7 @@ def api_diagnose():
 @login_required
 def api_follow_up():
     """Follow-up chat for farm plans using Gemini AI"""
-    data = request.get_json()
+    data = get_json_body()
     plan_id, question = data.get('plan_id'), data.get('question')
     
     if not all([plan_id, question]): 
@@ -569,53 +1098,50 @@ def api_follow_up():
     if len(question.strip()) < 3:
         return jsonify({'error': 'Question must be at least 3 characters'}), 400
     
-    conn = get_db_connection()
-    plan = conn.execute(
-        'SELECT * FROM farm_plans WHERE id = ? AND user_id = ?',
-        (plan_id, current_user.id)
-    ).fetchone()
+    plan = get_owned_plan(plan_id, f'COALESCE(plan_md, plan_html) AS plan_context, {PLAN_RECENT_CHAT}')
     
     if not plan:
-        conn.close()
         return jsonify({'error': 'Plan not found or access denied'}), 404
     
-    history = conn.execute(
-        'SELECT role, content FROM chat_history WHERE plan_id = ? ORDER BY created_at ASC',
-        (plan_id,)
-    ).fetchall()
+    history = app.json.loads(plan['chat_history'])
     
-    conn.execute('INSERT INTO chat_history (plan_id, role, content) VALUES (?, ?, ?)', (plan_id, 'user', question))
-    conn.commit()
+    if not GOOGLE_API_KEY:
+        return jsonify({'error': 'AI service is currently unavailable.'}), 503
     
-    try:
-        if not gemini_model:
-            conn.close()
-            return jsonify({'error': 'AI service is currently unavailable.'}), 503
-        
-        # Build conversation context
-        conversation = f"Initial Farm Plan:\n{plan['plan_html']}\n\n"
-        for message in history:
-            conversation += f"{message['role'].capitalize()}: {message['content']}\n"
-        conversation += f"\nUser's new question: {question}\n\nProvide a helpful, practical answer:"
-        
-        response = gemini_model.generate_content(conversation)
-        answer = response.text
-        
-        conn.execute('INSERT INTO chat_history (plan_id, role, content) VALUES (?, ?, ?)', (plan_id, 'assistant', answer))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'answer': markdown.markdown(answer)})
-    except Exception as e:
-        conn.close()
-        print(f"Error in follow_up: {e}")
-        return jsonify({'error': 'Sorry, an error occurred.'}), 500
+    # Build conversation context
+    conversation = '\n'.join([
+        f"Initial Farm Plan:\n{plan['plan_context']}\n",
+        *(f"{message['role'].capitalize()}: {message['content']}" for message in history),
+        f"\nUser's new question: {question}\n\nProvide a helpful, practical answer:",
+    ])
+    
+    def events():
+        try:
+            answer = yield from relay_chunks(stream_gemini_text(conversation))
+            
+            answer_html = render_md(answer)
+            
+            # Save both turns of the exchange in one transaction
+            conn = get_db_connection()
+            conn.executemany(
+                'INSERT INTO chat_history (plan_id, role, content, content_html) VALUES (?, ?, ?, ?)',
+                [(plan_id, 'user', question, None), (plan_id, 'assistant', answer, answer_html)]
+            )
+            conn.commit()
+            
+            yield sse_event({'answer': answer_html})
+        except Exception as e:
+            print(f"Error in follow_up: {e}")
+            yield sse_event({'error': 'Sorry, an error occurred.'})
+        yield SSE_DONE
+    
+    return sse_response(events())
 
 @app.route('/api/diagnose_follow_up', methods=['POST'])
 @login_required
 def api_diagnose_follow_up():
     """Follow-up chat for diagnoses using Gemini AI"""
-    data = request.get_json()
+    data = get_json_body()
     diagnosis_id, question = data.get('diagnosis_id'), data.get('question')
     
     if not all([diagnosis_id, question]): 
@@ -624,177 +1150,158 @@ def api_diagnose_follow_up():
     if len(question.strip()) < 3:
         return jsonify({'error': 'Question must be at least 3 characters'}), 400
     
-    conn = get_db_connection()
-    diagnosis = conn.execute(
-        'SELECT * FROM diagnoses WHERE id = ? AND user_id = ?',
-        (diagnosis_id, current_user.id)
-    ).fetchone()
+    diagnosis = get_owned_diagnosis(diagnosis_id, f'COALESCE(report_md, report_html) AS report_context, {DIAGNOSIS_RECENT_CHAT}')
     
     if not diagnosis:
-        conn.close()
         return jsonify({'error': 'Diagnosis not found or access denied'}), 404
     
-    history = conn.execute(
-        'SELECT role, content FROM diagnoses_chat_history WHERE diagnosis_id = ? ORDER BY created_at ASC',
-        (diagnosis_id,)
-    ).fetchall()
+    history = app.json.loads(diagnosis['chat_history'])
     
-    conn.execute('INSERT INTO diagnoses_chat_history (diagnosis_id, role, content) VALUES (?, ?, ?)', (diagnosis_id, 'user', question))
-    conn.commit()
+    if not GOOGLE_API_KEY:
+        return jsonify({'error': 'AI service is currently unavailable.'}), 503
     
-    try:
-        if not gemini_model:
-            conn.close()
-            return jsonify({'error': 'AI service is currently unavailable.'}), 503
-        
-        # Build conversation context
-        conversation = f"Initial Diagnosis:\n{diagnosis['report_html']}\n\n"
-        for message in history:
-            conversation += f"{message['role'].capitalize()}: {message['content']}\n"
-        conversation += f"\nUser's new question: {question}\n\nProvide a helpful answer:"
-        
-        response = gemini_model.generate_content(conversation)
-        answer = response.text
-        
-        conn.execute('INSERT INTO diagnoses_chat_history (diagnosis_id, role, content) VALUES (?, ?, ?)', (diagnosis_id, 'assistant', answer))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'answer': markdown.markdown(answer)})
-    except Exception as e:
-        conn.close()
-        print(f"Error in diagnose_follow_up: {e}")
-        return jsonify({'error': 'Sorry, an error occurred.'}), 500
+    # Build conversation context
+    conversation = '\n'.join([
+        f"Initial Diagnosis:\n{diagnosis['report_context']}\n",
+        *(f"{message['role'].capitalize()}: {message['content']}" for message in history),
+        f"\nUser's new question: {question}\n\nProvide a helpful answer:",
+    ])
+    
+    def events():
+        try:
+            answer = yield from relay_chunks(stream_gemini_text(conversation))
+            
+            answer_html = render_md(answer)
+            
+            # Save both turns of the exchange in one transaction
+            conn = get_db_connection()
+            conn.executemany(
+                'INSERT INTO diagnoses_chat_history (diagnosis_id, role, content, content_html) VALUES (?, ?, ?, ?)',
+                [(diagnosis_id, 'user', question, None), (diagnosis_id, 'assistant', answer, answer_html)]
+            )
+            conn.commit()
+            
+            yield sse_event({'answer': answer_html})
+        except Exception as e:
+            print(f"Error in diagnose_follow_up: {e}")
+            yield sse_event({'error': 'Sorry, an error occurred.'})
+        yield SSE_DONE
+    
+    return sse_response(events())
 
 @app.route('/api/knowledge_query', methods=['POST'])
 def api_knowledge_query():
     """Answer farming questions using Gemini AI - Available to ALL users"""
-    data = request.get_json()
+    data = get_json_body()
     query = data.get('query') or data.get('question')
     
     if not query or len(query.strip()) < 3:
         return jsonify({'error': 'Question must be at least 3 characters'}), 400
     
-    try:
-        if not gemini_model:
-            return jsonify({'error': 'AI service is currently unavailable.'}), 503
-        
-        # Get user context if available
-        user_context = ""
-        if current_user.is_authenticated:
-            conn = get_db_connection()
-            recent_plan = conn.execute(
-                'SELECT location, country FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
-                (current_user.id,)
-            ).fetchone()
-            conn.close()
-            
-            if recent_plan:
-                user_context = f"\n\nUser is located in: {recent_plan['location']}, {recent_plan['country']}"
-        
-        prompt = f"""You are an expert agricultural advisor with decades of farming experience in Nigeria and West Africa. Answer this farming question with practical, actionable advice tailored for African smallholder farmers.
-
-Question: {query}{user_context}
-
-Provide a clear, helpful answer in 2-4 paragraphs. Focus on:
-- Practical advice Nigerian/African farmers can implement immediately
-- Location-specific recommendations (Nigerian climate zones, soil types, seasons)
-- Cost-effective solutions using locally available materials and resources
-- Both traditional African farming wisdom and modern agricultural techniques
-- Reference Nigerian crops (cassava, maize, rice, yam, vegetables, plantain) when relevant
-- Consider Nigerian agricultural realities (weather patterns, market access, smallholder constraints)
-
-Keep it conversational and easy to understand. Use simple language suitable for farmers with varying education levels."""
-        
-        response = gemini_model.generate_content(prompt)
-        answer_html = markdown.markdown(response.text)
+    if not GOOGLE_API_KEY:
+        return jsonify({'error': 'AI service is currently unavailable.'}), 503
+    
+    # Get user context if available
+    user_context = ""
+    if current_user.is_authenticated:
+        conn = get_db_connection()
+        recent_plan = conn.execute(
+            'SELECT location, country FROM farm_plans WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
+            (current_user.id,)
+        ).fetchone()
         
-        return jsonify({'answer': answer_html, 'response': answer_html})
-    except Exception as e:
-        print(f"Error in knowledge_query: {e}")
-        return jsonify({'error': 'Sorry, an error occurred. Please try again.'}), 500
+        if recent_plan:
+            user_context = f"\n\nUser is located in: {recent_plan['location']}, {recent_plan['country']}"
+    
+    prompt = KNOWLEDGE_QUESTION_TEMPLATE.substitute(query=query, user_context=user_context)
+    
+    def events():
+        try:
+            answer = yield from relay_chunks(stream_gemini_text(prompt, KNOWLEDGE_INSTRUCTION, cached=True))
+            answer_html = render_md(answer)
+            yield sse_event({'answer': answer_html})
+        except Exception as e:
+            print(f"Error in knowledge_query: {e}")
+            yield sse_event({'error': 'Sorry, an error occurred. Please try again.'})
+        yield SSE_DONE
+    
+    return sse_response(events())
 
 # --- UTILITY API ROUTES ---
 @app.route('/api/create_showcase', methods=['POST'])
 @login_required
 def api_create_showcase():
     """Create public showcase for a plan"""
-    data = request.get_json()
+    data = get_json_body()
     plan_id = data.get('plan_id')
     
     if not plan_id: 
         return jsonify({'error': 'Plan ID is required'}), 400
     
-    conn = get_db_connection()
-    plan = conn.execute(
-        'SELECT * FROM farm_plans WHERE id = ? AND user_id = ?',
-        (plan_id, current_user.id)
-    ).fetchone()
+    plan = get_owned_plan(plan_id, 'showcase_id')
     
     if not plan:
-        conn.close()
         return jsonify({'error': 'Plan not found or access denied'}), 404
     
-    existing = conn.execute(
-        'SELECT showcase_id FROM farm_plans WHERE id = ? AND user_id = ?',
-        (plan_id, current_user.id)
-    ).fetchone()
+    # Repeat clicks on an already shared plan are answered without a write
+    if plan['showcase_id']:
+        return jsonify({'showcase_id': plan['showcase_id']})
     
-    if existing and existing['showcase_id']:
-        conn.close()
-        return jsonify({'showcase_id': existing['showcase_id']})
-    
-    showcase_id = str(uuid.uuid4())
-    conn.execute(
-        'UPDATE farm_plans SET showcase_id = ? WHERE id = ? AND user_id = ?',
-        (showcase_id, plan_id, current_user.id)
-    )
+    # COALESCE keeps whichever id a concurrent request stored first
+    conn = get_db_connection()
+    plan = conn.execute(
+        'UPDATE farm_plans SET showcase_id = COALESCE(showcase_id, ?) WHERE id = ? AND user_id = ? RETURNING showcase_id',
+        (secrets.token_urlsafe(8), plan_id, current_user.id)
+    ).fetchone()
     conn.commit()
-    conn.close()
     
-    return jsonify({'showcase_id': showcase_id})
+    if not plan:  # deleted in the meantime
+        return jsonify({'error': 'Plan not found or access denied'}), 404
+    
+    return jsonify({'showcase_id': plan['showcase_id']})
 
 @app.route('/api/get_plan/<int:plan_id>', methods=['GET'])
 @login_required
 def get_plan(plan_id):
     """Get plan details with chat history"""
-    conn = get_db_connection()
-    plan = conn.execute(
-        'SELECT * FROM farm_plans WHERE id = ? AND user_id = ?',
-        (plan_id, current_user.id)
-    ).fetchone()
-    chat_history = conn.execute(
-        'SELECT role, content FROM chat_history WHERE plan_id = ? ORDER BY created_at ASC',
-        (plan_id,)
-    ).fetchall()
-    conn.close()
+    plan = get_owned_plan(plan_id, f'{PLAN_COLUMNS}, {PLAN_CHAT_HISTORY}')
     
     if plan is None: 
         return jsonify({'error': 'Plan not found'}), 404
     
-    return jsonify({
-        'plan': dict(plan),
-        'chat_history': [dict(row) for row in chat_history]
-    })
+    plan = dict(plan)
+    chat_history = plan.pop('chat_history')
+    
+    # Chat only ever grows, so the length of its JSON identifies the version
+    etag = make_etag(plan['id'], plan['created_at'], len(chat_history))
+    if is_not_modified(etag):
+        return not_modified(etag)
+    
+    # SQLite already built the chat array as JSON, so it is embedded without re-parsing
+    return with_etag(jsonify({
+        'plan': plan,
+        'chat_history': orjson.Fragment(chat_history)
+    }), etag)
 
 @app.route('/api/delete_plan/<int:plan_id>', methods=['DELETE'])
 @login_required
 def delete_plan(plan_id):
     """Delete a farm plan"""
+    # Ownership check and delete in one statement; chat history cascades
     conn = get_db_connection()
     plan = conn.execute(
-        'SELECT * FROM farm_plans WHERE id = ? AND user_id = ?',
+        'DELETE FROM farm_plans WHERE id = ? AND user_id = ? RETURNING id, created_at',
         (plan_id, current_user.id)
     ).fetchone()
+    conn.commit()
     
     if not plan:
-        conn.close()
         return jsonify({'error': 'Plan not found or access denied'}), 404
     
-    conn.execute('DELETE FROM chat_history WHERE plan_id = ?', (plan_id,))
-    conn.execute('DELETE FROM farm_plans WHERE id = ? AND user_id = ?', (plan_id, current_user.id))
-    conn.commit()
-    conn.close()
+    try:
+        os.remove(pdf_cache_path(plan))
+    except FileNotFoundError:
+        pass
     
     return jsonify({'success': True})
 
@@ -802,24 +1309,24 @@ def delete_plan(plan_id):
 @login_required
 def get_diagnosis(diagnosis_id):
     """Get diagnosis details with chat history"""
-    conn = get_db_connection()
-    diagnosis = conn.execute(
-        'SELECT * FROM diagnoses WHERE id = ? AND user_id = ?',
-        (diagnosis_id, current_user.id)
-    ).fetchone()
-    chat_history = conn.execute(
-        'SELECT role, content FROM diagnoses_chat_history WHERE diagnosis_id = ? ORDER BY created_at ASC',
-        (diagnosis_id,)
-    ).fetchall()
-    conn.close()
+    diagnosis = get_owned_diagnosis(diagnosis_id, f'{DIAGNOSIS_COLUMNS}, {DIAGNOSIS_CHAT_HISTORY}')
     
     if diagnosis is None: 
         return jsonify({'error': 'Diagnosis not found'}), 404
     
-    return jsonify({
-        'diagnosis': dict(diagnosis),
-        'chat_history': [dict(row) for row in chat_history]
-    })
+    diagnosis = dict(diagnosis)
+    chat_history = diagnosis.pop('chat_history')
+    
+    # Chat only ever grows, so the length of its JSON identifies the version
+    etag = make_etag(diagnosis['id'], diagnosis['created_at'], len(chat_history))
+    if is_not_modified(etag):
+        return not_modified(etag)
+    
+    # SQLite already built the chat array as JSON, so it is embedded without re-parsing
+    return with_etag(jsonify({
+        'diagnosis': diagnosis,
+        'chat_history': orjson.Fragment(chat_history)
+    }), etag)
     
 @app.route('/api/delete_diagnosis/<int:diagnosis_id>', methods=['DELETE'])
 @login_required
@@ -827,19 +1334,14 @@ def delete_diagnosis(diagnosis_id):
     """Delete a diagnosis"""
     conn = get_db_connection()
     diagnosis = conn.execute(
-        'SELECT * FROM diagnoses WHERE id = ? AND user_id = ?',
+        'DELETE FROM diagnoses WHERE id = ? AND user_id = ? RETURNING id',
         (diagnosis_id, current_user.id)
     ).fetchone()
+    conn.commit()
     
     if not diagnosis:
-        conn.close()
         return jsonify({'error': 'Diagnosis not found or access denied'}), 404
     
-    conn.execute('DELETE FROM diagnoses_chat_history WHERE diagnosis_id = ?', (diagnosis_id,))
-    conn.execute('DELETE FROM diagnoses WHERE id = ? AND user_id = ?', (diagnosis_id, current_user.id))
-    conn.commit()
-    conn.close()
-    
     return jsonify({'success': True})
 
 @app.route('/api/search_plans', methods=['GET'])
@@ -851,63 +1353,98 @@ def api_search_plans():
         return jsonify({'plans': []})
     
     conn = get_db_connection()
-    plans = conn.execute(
-        'SELECT * FROM farm_plans WHERE user_id = ? AND location LIKE ? ORDER BY created_at DESC LIMIT 10',
-        (current_user.id, f'%{query}%')
-    ).fetchall()
-    conn.close()
+    if len(query) >= 3:
+        # The trigram index matches substrings, so quote the query as a single phrase
+        plans = conn.execute(
+            'SELECT p.id, p.location, p.country, p.currency, p.showcase_id, p.created_at '
+            'FROM farm_plans_fts f JOIN farm_plans p ON p.id = f.rowid '
+            'WHERE farm_plans_fts MATCH ? AND p.user_id = ? ORDER BY p.created_at DESC LIMIT 10',
+            ('"' + query.replace('"', '""') + '"', current_user.id)
+        ).fetchall()
+    else:
+        # Too short for a trigram lookup
+        plans = conn.execute(
+            f'SELECT {PLAN_LIST_COLUMNS} FROM farm_plans WHERE user_id = ? AND location LIKE ? ORDER BY created_at DESC LIMIT 10',
+            (current_user.id, f'%{query}%')
+        ).fetchall()
     
     return jsonify({'plans': [dict(plan) for plan in plans]})
 
 @app.route('/api/export_data', methods=['GET'])
 @login_required
 def api_export_data():
-    """Export user's data as JSON"""
-    conn = get_db_connection()
-    plans = conn.execute('SELECT * FROM farm_plans WHERE user_id = ?', (current_user.id,)).fetchall()
-    diagnoses = conn.execute('SELECT * FROM diagnoses WHERE user_id = ?', (current_user.id,)).fetchall()
-    conn.close()
+    """Export user's data as JSON, streamed row by row"""
+    user_id = current_user.id
+    user = {'name': current_user.name, 'email': current_user.email}
     
-    export_data = {
-        'user': {
-            'name': current_user.name,
-            'email': current_user.email
-        },
-        'plans': [dict(plan) for plan in plans],
-        'diagnoses': [dict(diagnosis) for diagnosis in diagnoses],
-        'exported_at': datetime.now().isoformat()
-    }
-    
-    response = make_response(jsonify(export_data))
-    response.headers['Content-Disposition'] = f'attachment; filename=yieldwise_data_{current_user.id}.json'
+    def json_array(cursor):
+        # Plain tuples zipped with the column names once, instead of building a dict from each sqlite3.Row
+        columns = [column[0] for column in cursor.description]
+        cursor.row_factory = None
+        for index, row in enumerate(cursor):
+            yield (',' if index else '') + app.json.dumps(dict(zip(columns, row)))
+    
+    def generate():
+        conn = get_db_connection()
+        yield '{"user":' + app.json.dumps(user) + ',"plans":['
+        yield from json_array(conn.execute(f'SELECT {PLAN_COLUMNS} FROM farm_plans WHERE user_id = ?', (user_id,)))
+        yield '],"diagnoses":['
+        yield from json_array(conn.execute(f'SELECT {DIAGNOSIS_COLUMNS} FROM diagnoses WHERE user_id = ?', (user_id,)))
+        yield '],"exported_at":' + app.json.dumps(datetime.now().isoformat()) + '}'
+    
+    body = stream_with_context(generate())
+    gzipped = 'gzip' in request.accept_encodings
+    response = Response(
+        gzip_stream(body) if gzipped else body,
+        mimetype='application/json',
+        headers={'Content-Disposition': f'attachment; filename=yieldwise_data_{user_id}.json'}
+    )
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
     return response
 
+# Everything but the timestamp is fixed for the life of the process
+HEALTH_STATUS = {
+    'status': 'healthy',
+    'services': {
+        'gemini_api': 'available' if GOOGLE_API_KEY else 'unavailable',
+        'database': 'available'
+    },
+    'version': '3.0.0',
+    'features': ['farm_planning', 'plant_diagnosis', 'knowledge_base', 'chat_support', 'pdf_export']
+}
+
 @app.route('/api/health', methods=['HEAD', 'GET'])
 def health_check():
     """System health check"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'services': {
-            'gemini_api': 'available' if gemini_model else 'unavailable',
-            'database': 'available'
-        },
-        'version': '3.0.0',
-        'features': ['farm_planning', 'plant_diagnosis', 'knowledge_base', 'chat_support', 'pdf_export']
-    })
+    return jsonify({**HEALTH_STATUS, 'timestamp': datetime.now().isoformat()})
 
 # --- ERROR HANDLERS ---
+# Error pages only vary with the viewer's nav and flashed messages, so the anonymous
+# rendering is kept and reused; signed-in users still get theirs rendered per request
+_error_pages = {}
+TOO_LARGE_JSON = app.json.dumps({'error': 'File too large. Maximum size is 8MB.'})
+
+def render_error_page(template):
+    if current_user.is_authenticated or '_flashes' in session:
+        return render_template(template)
+    key = (template, request.endpoint)
+    if key not in _error_pages:
+        _error_pages[key] = render_template(template)
+    return _error_pages[key]
+
 @app.errorhandler(404)
 def not_found_error(error):
-    return render_template('404.html'), 404
+    return render_error_page('404.html'), 404
 
 @app.errorhandler(500)
 def internal_error(error):
-    return render_template('500.html'), 500
+    return render_error_page('500.html'), 500
 
 @app.errorhandler(413)
 def too_large(error):
-    return jsonify({'error': 'File too large. Maximum size is 16MB.'}), 413
+    return Response(TOO_LARGE_JSON, status=413, mimetype='application/json')
 
 # --- MAIN EXECUTION ---
 if __name__ == '__main__':
@@ -59,6 +59,73 @@ async function fetchJSON(url, options = {}) {
     }
 }
 
+async function fetchStream(url, options = {}, onChunk = () => {}) {
+    try {
+        showLoading();
+        const response = await fetch(url, options);
+        const contentType = response.headers.get('Content-Type') || '';
+        
+        if (!contentType.includes('text/event-stream')) {
+            const data = await response.json();
+            hideLoading();
+            
+            if (!response.ok || data.error) {
+                throw new Error(data.error || 'An error occurred');
+            }
+            
+            return data;
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let result = null;
+        
+        try {
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop();
+                
+                for (const event of events) {
+                    const payload = event.replace(/^data: /, '');
+                    if (payload === '[DONE]') continue;
+                    
+                    const data = JSON.parse(payload);
+                    if (data.error) {
+                        throw new Error(data.error);
+                    }
+                    
+                    if (data.chunk !== undefined) {
+                        hideLoading();
+                        onChunk(data.chunk);
+                    } else {
+                        result = data;
+                    }
+                }
+            }
+        } finally {
+            // Frees the connection when an error event ends the read early
+            reader.cancel().catch(() => {});
+        }
+        
+        if (!result) {
+            // A proxy or a recycled worker can cut the stream before the final event
+            throw new Error('The response was interrupted. Please try again.');
+        }
+        
+        hideLoading();
+        return result;
+    } catch (error) {
+        hideLoading();
+        showNotification(error.message, 'danger');
+        throw error;
+    }
+}
+
 document.addEventListener('DOMContentLoaded', function() {
     const tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
     tooltipTriggerList.map(function (tooltipTriggerEl) {
@@ -0,0 +1,22 @@
+# YieldWise AI - Production entry point
+# Run with: gunicorn -k gevent -w 2 --worker-connections 500 wsgi:app
+
+# gevent must patch sockets and threading before Flask, requests or the
+# Gemini client import them, so in-flight Gemini calls yield to other requests
+from gevent import monkey
+monkey.patch_all()
+
+# The Gemini SDK talks gRPC, which needs its own gevent integration
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+import os  # noqa: E402
+
+from app import app, init_db  # noqa: E402
+
+# Each worker would otherwise sign sessions with its own random key, so a login
+# or guest plan made on one worker would be rejected by the others
+if not os.getenv('SECRET_KEY'):
+    raise RuntimeError('SECRET_KEY must be set when running under gunicorn')
+
+init_db()